@@ -4,19 +4,24 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import sys
 import threading
 import time
 import traceback
 from enum import Enum
+from typing import Callable
 
 import hid  # requires installing specifically https://pypi.org/project/hidapi/
 import win32con
 import win32gui
 from dotenv import load_dotenv
-from pyee.asyncio import AsyncIOEventEmitter
-from flask import Flask, jsonify
+from flask import Flask, Response, stream_with_context
 from flask_cors import CORS
 from waitress import serve
 
@@ -26,24 +31,91 @@ VENDOR_ID = 2385
 PRODUCT_ID = 5866
 USAGE_PAGE = 65299
 WINDOW_TITLE = 'Check Battery Server'
+STREAM_KEEPALIVE = 15  # seconds between keepalive comments, a disconnected stream frees its thread on the next one
 
 load_dotenv()
 PORT = 9833
 HOST = os.getenv('HEADSET_SERVER_HOST', 'localhost')
+# every /battery_stream client holds a worker thread for as long as it's connected (and up to STREAM_KEEPALIVE after
+# it left), so size the pool from the expected stream clients plus a spare for /battery_status.
+# the default covers one tray icon whose previous stream hasn't been noticed as closed yet
+STREAM_CLIENTS = int(os.getenv('HEADSET_STREAM_CLIENTS', 2))
+SERVER_THREADS = int(os.getenv('HEADSET_SERVER_THREADS', STREAM_CLIENTS + 1))
+_UNKNOWN_JSON = json.dumps({'battery_status': 'unknown'}).encode()
+_STATUS_JSON_TEMPLATE = b'{"battery_status": %d}'  # same output as json.dumps, without building a dict per request
+
+# log through a queue, so the HID and server threads only enqueue and the console I/O happens on the listener thread
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+log = logging.getLogger('headset_interface')
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(logging.INFO)
+log.propagate = False
+
+
+class AtomicValue:
+    """
+    A value shared between the HID thread and the server threads. Readers can block until it changes.
+    """
+    def __init__(self, value=None):
+        self._value = value
+        self._changed = threading.Condition()
+
+    def load(self):
+        with self._changed:
+            return self._value
+
+    def store(self, value):
+        with self._changed:
+            self._value = value
+            self._changed.notify_all()
+
+    def wait_for_change(self, old, timeout=None):
+        """
+        Blocks until the value differs from `old` or `timeout` seconds pass, then returns the current value.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._value != old, timeout=timeout)
+            return self._value
+
 
 app = Flask(__name__)
 flask_logger = logging.getLogger('werkzeug')
 flask_logger.setLevel(logging.ERROR)
 CORS(app)
+app.battery_status = AtomicValue()
 
 
 @app.route('/battery_status')
 def battery_status():
-    if not hasattr(app, 'battery_status') or app.battery_status is None:
-        print("Was requested for battery status, but it's not available.")
-        return jsonify({'battery_status': 'unknown'})
-    print(f"Returning battery status: {app.battery_status}")
-    return jsonify({'battery_status': app.battery_status})
+    status = app.battery_status.load()
+    if status is None:
+        log.info("Was requested for battery status, but it's not available.")
+        return Response(_UNKNOWN_JSON, mimetype='application/json')
+    log.info(f"Returning battery status: {status}")
+    return Response(_STATUS_JSON_TEMPLATE % status, mimetype='application/json')
+
+
+@app.route('/battery_stream')
+def battery_stream():
+    """
+    Server-Sent Events stream that pushes the battery status only when it changes.
+    /battery_status is kept for clients that don't support streaming.
+    """
+    def gen():
+        sent = object()  # sentinel, so the current status is always sent right after connecting
+        while True:
+            status = app.battery_status.wait_for_change(sent, timeout=STREAM_KEEPALIVE)
+            if status == sent:
+                yield ': keepalive\n\n'  # lets the client watchdog know the connection is still alive
+                continue
+            sent = status
+            yield f"data: {'unknown' if status is None else status}\n\n"
+
+    return Response(stream_with_context(gen()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 # todo: add a websocket endpoint for the app to announce to the listener
@@ -51,16 +123,20 @@ def battery_status():
 def hide_window(in_title: str, actually_show_it_instead=False):
     program_hwnd = None
 
-    def win_enum_handler(hwnd, ctx) -> [None, int]:
+    def win_enum_handler(hwnd, ctx) -> [None, bool]:
         title = win32gui.GetWindowText(hwnd)
         if in_title in title:
             nonlocal program_hwnd
             program_hwnd = hwnd
-            win32gui.ShowWindow(hwnd, win32con.SW_HIDE)
-            if actually_show_it_instead:
-                win32gui.ShowWindow(hwnd, win32con.SW_SHOW)
+            win32gui.ShowWindow(hwnd, win32con.SW_SHOW if actually_show_it_instead else win32con.SW_HIDE)
+            return False  # found it, stop enumerating the rest of the windows
 
-    win32gui.EnumWindows(win_enum_handler, None)
+    try:
+        win32gui.EnumWindows(win_enum_handler, None)
+    except win32gui.error:
+        # older pywin32 versions raise when the callback stops the enumeration early
+        if program_hwnd is None:
+            raise
     return program_hwnd
 
 
@@ -73,106 +149,199 @@ class CommandMeaning(Enum):
     type_battery_status = 2
 
 
-class HyperXCloudFlightS(AsyncIOEventEmitter):
-    def __init__(self, flask_app, debug=False, update_delay=300, invalidate_after=1800):
-        super().__init__()
-        self.debug = debug
+# plain ints, so process_data doesn't go through the Enum on every packet
+_POS_INFO = CommandMeaning.position_info.value
+_POS_BAT = CommandMeaning.position_battery.value
+_TYPE_BAT = CommandMeaning.type_battery_status.value
+_PROBE = bytes([0x21] + [0x00] * 19)  # report that prompts the headset to start sending its status
+
+
+class HyperXCloudFlightS:
+    def __init__(self, flask_app, debug=False, update_delay=300, invalidate_after=1800, min_emit_interval=1.0):
+        self._listeners: dict[str, list[Callable]] = {}
+        if debug:
+            log.setLevel(logging.DEBUG)
         self.update_delay = update_delay
         self.invalidate_after = invalidate_after
-        self.devices = [d for d in hid.enumerate(VENDOR_ID, PRODUCT_ID)]
-        if not self.devices:
-            print("HyperX Cloud Flight S was not found. Searching for it...")
-            # raise Exception('HyperX Cloud Flight S was not found')
+        self.min_emit_interval = min_emit_interval
         self.bootstrap_device = None
-        self.interval = None
+        self.last_device_path = None
         self.battery_status = None
         self.app = flask_app
         self.flask_thread = None
         self.last_battery_update_at = None
+        self._last_emit_at = 0.0
+        self._emitted_battery_status = None
+        self._emit_timer = None
+        self._emit_lock = threading.RLock()
         self.device_ready = threading.Event()
-        self.bootstrap()
+        self._device_lock = threading.RLock()  # held while reading, so the handle isn't closed mid-read
+        self._stop = threading.Event()
+        self._kick = threading.Event()  # wakes the bootstrap thread before update_delay runs out
+        threading.Thread(target=self._bootstrap_loop, daemon=True).start()
+
+    def on(self, event, callback):
+        self._listeners.setdefault(event, []).append(callback)
+        return callback
+
+    def emit(self, event, *args):
+        """
+        Calls the listeners synchronously. Like pyee, an 'error' nobody listens to is raised instead.
+        """
+        listeners = self._listeners.get(event)
+        if not listeners:
+            if event == 'error' and args and isinstance(args[0], BaseException):
+                raise args[0]
+            return
+        for callback in listeners:
+            callback(*args)
 
     def start_flask_server(self):
         def run_server():
-            print(f"Starting server at http://{HOST}:{PORT}")
-            serve(self.app, host=HOST, port=PORT)
+            log.info(f"Starting server at http://{HOST}:{PORT}")
+            serve(self.app, host=HOST, port=PORT, threads=SERVER_THREADS, connection_limit=64, channel_timeout=30)
 
         self.flask_thread = threading.Thread(target=run_server, daemon=True)
         self.flask_thread.start()
 
-    def bootstrap(self):
+    @staticmethod
+    def _open_device(path):
+        device = hid.device()
         try:
-            if self.last_battery_update_at is not None and time.time() - self.last_battery_update_at > self.invalidate_after:
-                print(f"Invalidating battery status at {time.strftime('%H:%M:%S')}")
-                self.app.battery_status = None
-                self.device_ready.clear()
-                self.bootstrap_device = None  # invalidating the device to re-find it if it got unplugged
-
-            if self.bootstrap_device is None:
-                if not self.devices:
-                    self.devices = [d for d in hid.enumerate(VENDOR_ID, PRODUCT_ID)]
-
-                for device in self.devices:
-                    if device['usage_page'] == USAGE_PAGE and device['usage'] == 1:
-                        self.bootstrap_device = hid.device()
-                        try:
-                            self.bootstrap_device.open_path(device['path'])
-                        except OSError:
-                            self.bootstrap_device = None
-                            continue
-                        break
-
-            if self.bootstrap_device is None:
-                print(f"Searched for headset at {time.strftime('%H:%M:%S')}. Not found.")
-                return
+            device.open_path(path)
+        except OSError:
+            return None
+        return device
+
+    def _drop_device(self):
+        with self._device_lock:
+            device, self.bootstrap_device = self.bootstrap_device, None
+            if device is not None:
+                try:
+                    device.close()
+                except Exception:
+                    pass  # it's gone either way
+
+    def stop(self):
+        self._stop.set()
+        self._kick.set()
+        self.device_ready.set()  # wake run() if it's waiting for the headset, it checks _stop right after
 
-            if self.device_ready.is_set():
-                return  # prevent re-running the check and prompting the headset unnecessarily
+    def _bootstrap_loop(self):
+        while not self._stop.is_set():
+            self._kick.clear()  # before the attempt, so a kick that comes in during it isn't lost
             try:
-                buffer = [0x21] + [0x00] * 19
-                self.bootstrap_device.write(buffer)
-                print(f"Searched for headset at {time.strftime('%H:%M:%S')}. Found.")
-                self.device_ready.set()
-            except OSError:
-                print("Had an OSError, was the pc was set to sleep just then, or the device got unplugged?")
-            except Exception as e:
-                self.emit('error', e)
-        finally:
-            self.interval = threading.Timer(self.update_delay, self.bootstrap)
-            # ^ re-define this to have it check over and over. Don't check if it's None
-            self.interval.start()
+                self._bootstrap_once()
+            except Exception:
+                log.exception("Bootstrap failed")  # keep checking over and over, even if one attempt blew up
+            self._kick.wait(self.update_delay)
+
+    def _bootstrap_once(self, _time=time.time, _strftime=time.strftime):
+        # ^ time functions bound as defaults, so they're fast locals instead of global lookups
+        if self.last_battery_update_at is not None and _time() - self.last_battery_update_at > self.invalidate_after:
+            log.info(f"Invalidating battery status at {_strftime('%H:%M:%S')}")
+            self.battery_status = None  # so the next reading gets published even if it's the same value
+            self.app.battery_status.store(None)
+            self.device_ready.clear()
+            self._drop_device()  # invalidating the device to re-find it if it got unplugged
+
+        if self.bootstrap_device is not None and self.device_ready.is_set():
+            return  # prevent re-running the check and prompting the headset unnecessarily
+
+        if self.bootstrap_device is None and self.last_device_path is not None:
+            self.bootstrap_device = self._open_device(self.last_device_path)  # it usually comes back on the same path
+
+        if self.bootstrap_device is None:
+            for device in hid.enumerate(VENDOR_ID, PRODUCT_ID):
+                if device['usage_page'] != USAGE_PAGE or device['usage'] != 1:
+                    continue
+                self.bootstrap_device = self._open_device(device['path'])
+                if self.bootstrap_device is None:
+                    continue
+                self.last_device_path = device['path']
+                break
+
+        if self.bootstrap_device is None:
+            log.info(f"Searched for headset at {_strftime('%H:%M:%S')}. Not found.")
+            return
+
+        try:
+            self.bootstrap_device.write(_PROBE)
+            log.info(f"Searched for headset at {_strftime('%H:%M:%S')}. Found.")
+            self.device_ready.set()
+        except OSError:
+            log.info("Had an OSError, was the pc was set to sleep just then, or the device got unplugged?")
+        except Exception as e:
+            self.emit('error', e)
+
+    def _emit_battery_status(self, _monotonic=time.monotonic):
+        """
+        Emits the latest reading at most once per min_emit_interval, so the listeners don't get flooded when the
+        headset flaps between two readings. A reading that comes in too soon is emitted once the interval has passed.
+        """
+        with self._emit_lock:
+            status = self.battery_status
+            if status is None or status == self._emitted_battery_status:
+                return
+            wait = self._last_emit_at + self.min_emit_interval - _monotonic()
+            if self._emitted_battery_status is not None and wait > 0:
+                if self._emit_timer is None:
+                    self._emit_timer = threading.Timer(wait, self._flush_battery_status)
+                    self._emit_timer.daemon = True
+                    self._emit_timer.start()
+                return
+            self._last_emit_at = _monotonic()
+            self._emitted_battery_status = status
+            self.emit('battery_status', status)
+
+    def _flush_battery_status(self):
+        with self._emit_lock:
+            self._emit_timer = None
+            self._emit_battery_status()
 
     def run(self):
-        print(f"Started at {time.strftime('%X')}")
+        log.info(f"Started at {time.strftime('%X')}")
         self.device_ready.wait()
-        while True:
-            if self.bootstrap_device is None:
-                self.bootstrap()
+        while not self._stop.is_set():
+            with self._device_lock:
+                device = self.bootstrap_device  # the bootstrap thread may drop it at any time
+                if device is not None:
+                    try:
+                        # hidapi's read drops the GIL while it waits on USB, so the server threads keep running.
+                        # it times out so the stop flag gets checked, and the bootstrap thread can take the lock
+                        data = device.read(20, timeout_ms=500)
+                    except OSError:
+                        log.info("Had an OSError, was the pc was set to sleep just then, or the device got unplugged?")
+                        self.device_ready.clear()
+                        self._drop_device()
+                        self._kick.set()  # look for it right away instead of waiting for the next update_delay
+                        continue
+            if device is None:
+                # the bootstrap thread is (re)opening it, don't kick here: after an invalidation that would
+                # re-run the bootstrap, which invalidates again since the battery status is still stale, in a loop
                 self.device_ready.wait()
-            try:
-                data = self.bootstrap_device.read(20)
-            except OSError:
-                print("Had an OSError, was the pc was set to sleep just then, or the device got unplugged?")
-                self.bootstrap_device = None
-                self.device_ready.clear()
                 continue
-            if self.debug:
-                print(f"{data} length: {len(data)}")
-            if data:
-                self.process_data(data)
+            if not data:
+                continue
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"{data} length: {len(data)}")
+            self.process_data(data)
 
-    def process_data(self, data):
-        if data[CommandMeaning.position_info.value] == CommandMeaning.type_battery_status.value:
+    def process_data(self, data, _time=time.time):
+        # ^ called for every packet, time.time bound as a default to skip the global lookup
+        # hidapi already hands over the report as a list of ints (bytes work too), index it in place:
+        # converting it with bytes()/struct would cost an extra allocation per packet to read two fields
+        if data[_POS_INFO] == _TYPE_BAT:
             previous_battery_status = self.battery_status
-            self.battery_status = data[CommandMeaning.position_battery.value]
+            self.battery_status = data[_POS_BAT]
             if previous_battery_status == self.battery_status:
-                self.last_battery_update_at = time.time()  # prevent invalidating the status if the battery didn't decrease
+                self.last_battery_update_at = _time()  # prevent invalidating the status if the battery didn't decrease
                 return
-            self.emit('battery_status', self.battery_status)
+            self._emit_battery_status()
             # if self.debug:
-            self.app.battery_status = self.battery_status
-            print(f"Battery status: {self.battery_status}")
-            self.last_battery_update_at = time.time()
+            self.app.battery_status.store(self.battery_status)
+            log.info(f"Battery status: {self.battery_status}")
+            self.last_battery_update_at = _time()
 
 
 if __name__ == "__main__":
@@ -183,7 +352,8 @@ if __name__ == "__main__":
         headset.start_flask_server()
         headset.run()
     except KeyboardInterrupt:
-        pass
+        if headset is not None:
+            headset.stop()
     except Exception as e:
         traceback.print_exc()
         show_window(WINDOW_TITLE)
@@ -4,6 +4,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import functools
 import os
 import threading
 import time
@@ -16,6 +17,7 @@ import winsound
 from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
 from pystray import Icon, MenuItem
+from requests.adapters import HTTPAdapter
 
 from razbi_utils.core import toggle_visibility, show_window
 
@@ -24,24 +26,40 @@ WINDOW_TITLE = 'Show Battery As An Icon'
 BATTERY_VERY_LOW_AT = 15
 BATTERY_LOW_AT = 30
 BATTERY_CHARGED_AT = 85
+POLL_DELAY = 60  # seconds between polls when the battery stream is unavailable
+STREAM_WATCHDOG = 300  # reconnect if the battery stream stays silent for this long
+
+# reuse the same keep-alive connection to the server instead of opening a new socket per request
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
 
 
 def hide_window(in_title: str, actually_show_it_instead=False):
     program_hwnd = None
 
-    def win_enum_handler(hwnd, ctx) -> [None, int]:
+    def win_enum_handler(hwnd, ctx) -> [None, bool]:
         title = win32gui.GetWindowText(hwnd)
         if in_title in title:
             nonlocal program_hwnd
             program_hwnd = hwnd
-            win32gui.ShowWindow(hwnd, win32con.SW_HIDE)
-            if actually_show_it_instead:
-                win32gui.ShowWindow(hwnd, win32con.SW_SHOW)
+            win32gui.ShowWindow(hwnd, win32con.SW_SHOW if actually_show_it_instead else win32con.SW_HIDE)
+            return False  # found it, stop enumerating the rest of the windows
 
-    win32gui.EnumWindows(win_enum_handler, None)
+    try:
+        win32gui.EnumWindows(win_enum_handler, None)
+    except win32gui.error:
+        # older pywin32 versions raise when the callback stops the enumeration early
+        if program_hwnd is None:
+            raise
     return program_hwnd
 
 
+@functools.lru_cache(maxsize=None)
+def load_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+@functools.lru_cache(maxsize=128)  # at most 102 different charge levels (0-100 and -1), pystray doesn't mutate them
 def create_image(charge_level, width=64, height=64):
     text_color = (255, 255, 255)
     if isinstance(charge_level, int):
@@ -55,28 +73,40 @@ def create_image(charge_level, width=64, height=64):
     image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
     draw = ImageDraw.Draw(image)
 
-    font_size = height
     font_path = "arial.ttf"
     text = str(charge_level)
 
-    text_width, text_height = 0, 0
-
-    # reduce the font size until the text fits the image
-    while font_size > 0:
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-        except IOError:
-            font = ImageFont.load_default()
-            font_size -= 1
-            continue
+    def measure(measured_font):
+        bbox = draw.textbbox((0, 0), text, font=measured_font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
 
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+    def fits(measured_size):
+        return measured_size[0] <= width and measured_size[1] <= height
 
-        if text_width <= width and text_height <= height:
-            break
-        font_size -= 1
+    try:
+        reference_font = load_font(font_path, height)
+    except IOError:
+        font = ImageFont.load_default()
+        text_width, text_height = measure(font)
+    else:
+        # estimate the size from the text's length at full height instead of trying every size from the top
+        font_size = max(1, min(height, int(height * width / max(reference_font.getlength(text), 1))))
+        font = load_font(font_path, font_size)
+        text_width, text_height = measure(font)
+        # walk down in coarse steps until the text fits the image...
+        while not fits((text_width, text_height)) and font_size > 1:
+            font_size = max(1, font_size - 4)
+            font = load_font(font_path, font_size)
+            text_width, text_height = measure(font)
+        # ...then back up one size at a time to the biggest one that still fits, the estimate errs on the small side
+        while font_size < height:
+            bigger_font = load_font(font_path, font_size + 1)
+            bigger_size = measure(bigger_font)
+            if not fits(bigger_size):
+                break
+            font_size += 1
+            font = bigger_font
+            text_width, text_height = bigger_size
 
     x = (width - text_width) / 2
     y = (height - text_height) / 12
@@ -102,30 +132,59 @@ def setup(icon):
 
     def update():
         last_charge_level = -1
+
+        def apply(charge_level):
+            nonlocal last_charge_level
+            if charge_level == last_charge_level:
+                return
+            print(f"Updating icon with charge level: {charge_level}")
+            if (0 < last_charge_level < charge_level and charge_level >= BATTERY_CHARGED_AT) \
+                    or (0 < last_charge_level > charge_level and charge_level <= BATTERY_VERY_LOW_AT):
+                # ^ bigger than one to avoid playing the sfx when the charge level is -1 aka None
+                winsound.MessageBeep(
+                    winsound.MB_OK)  # TODO: change it to a more distinct sound or make the sfx work
+            last_charge_level = charge_level
+            update_icon(icon, charge_level)
+
         while icon.running:
-            charge_level = get_battery_level(host)
-            if charge_level != last_charge_level:
-                print(f"Updating icon with charge level: {charge_level}")
-                if (0 < last_charge_level < charge_level and charge_level >= BATTERY_CHARGED_AT) \
-                        or (0 < last_charge_level > charge_level and charge_level <= BATTERY_VERY_LOW_AT):
-                    # ^ bigger than one to avoid playing the sfx when the charge level is -1 aka None
-                    winsound.MessageBeep(
-                        winsound.MB_OK)  # TODO: change it to a more distinct sound or make the sfx work
-                last_charge_level = charge_level
-                update_icon(icon, charge_level)
-            time.sleep(60)
+            try:
+                for charge_level in stream_battery_levels(host):
+                    apply(charge_level)
+                    if not icon.running:
+                        return
+            except requests.exceptions.RequestException:
+                print("Battery stream unavailable, falling back to polling")
+            apply(get_battery_level(host))
+            time.sleep(POLL_DELAY)
 
     update_thread = threading.Thread(target=update, daemon=True)
     update_thread.start()
 
 
+def stream_battery_levels(host="localhost"):
+    """
+    Yields the charge level every time the server pushes a change.
+    Raises requests.exceptions.RequestException once the stream drops or goes silent for STREAM_WATCHDOG seconds.
+    """
+    with _session.get(f"http://{host}:9833/battery_stream", stream=True, timeout=(5, STREAM_WATCHDOG)) as res:
+        res.raise_for_status()
+        res.encoding = 'utf-8'
+        for line in res.iter_lines(decode_unicode=True):
+            if not line.startswith('data:'):
+                continue  # blank separators and keepalive comments
+            try:
+                yield int(line[len('data:'):])
+            except ValueError:  # status is 'unknown'
+                yield -1
+
+
 def get_battery_level(host="localhost"):
     try:
-        res = requests.get(f"http://{host}:9833/battery_status")
+        res = _session.get(f"http://{host}:9833/battery_status", timeout=2)
 
         battery_level = res.json()['battery_status']
         return int(battery_level)  # raises ValueError if status is not a number
-    except (requests.exceptions.ConnectionError, ValueError):
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError):
         print("Failed to request battery status")
         return -1
 